@@ -9,8 +9,11 @@ API Documentation: https://developer.sallinggroup.com/api-reference
 import logging
 import os
 import sys
+import threading
 import time
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from typing import Any
 
 import dlt
@@ -18,6 +21,11 @@ from dlt.sources.helpers.rest_client import RESTClient
 from dlt.sources.helpers.rest_client.paginators import SinglePagePaginator
 from loguru import logger
 
+# The food-waste API is queried once per zip code; requests run concurrently but their
+# start times stay spaced out to avoid triggering the API's spike protection
+REQUEST_INTERVAL_SECONDS = 2.0
+MAX_CONCURRENT_REQUESTS = 4
+
 
 class InterceptHandler(logging.Handler):
     """Intercept standard logging and redirect to loguru."""
@@ -38,68 +46,72 @@ class InterceptHandler(logging.Handler):
         logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
 
 
+class RateLimiter:
+    """Space out request start times across threads by a fixed interval."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self) -> None:
+        """Block until the caller's reserved start slot is reached."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
 def fetch_with_retry(
     client: RESTClient,
     endpoint: str,
     params: dict[str, Any] | None = None,
     max_retries: int = 5,
 ) -> list[dict[str, Any]]:
-    """Fetch data from API with automatic retry logic and rate limit handling.
+    """Fetch data from API, retrying responses that aren't a list of items.
+
+    Transport-level retries are handled by the RESTClient's session, which backs off
+    exponentially and honours `Retry-After`. Once its attempts run out it hands back
+    the last 429/5xx response (logged here and treated as no data), but re-raises
+    connection errors and timeouts. This only retries successful responses with a
+    malformed payload.
 
     Args:
         client: RESTClient instance configured with base URL and headers
         endpoint: API endpoint path
         params: Query parameters for the request
-        max_retries: Maximum number of retry attempts
+        max_retries: Maximum number of attempts for malformed payloads
 
     Returns:
         List of data items from the API response
 
     Raises:
-        Exception: If all retry attempts fail
+        HTTPError: If the API returns a client error other than rate limiting
+        RequestException: If the request still fails to connect or times out after
+            the session's retries
     """
     for attempt in range(max_retries):
+        response = client.get(endpoint, params=params or {})
+        # The session has already exhausted its retries for rate limits and server errors
+        if response.status_code == 429 or response.status_code >= 500:
+            logger.error(f"Request still failing after retries: HTTP {response.status_code} for {endpoint}")
+            return []
+        response.raise_for_status()
+
         try:
-            response = client.get(endpoint, params=params or {})
             data = response.json()
-            # Validate response is a list of dicts (API sometimes returns unexpected formats)
-            if not isinstance(data, list):
-                logger.warning(f"API returned {type(data).__name__} instead of list: {str(data)[:200]}")
-                if attempt < max_retries - 1:
-                    time.sleep(2**attempt)
-                    continue
-                return []
-            return data
-        except Exception as e:
-            error_msg = str(e)
-
-            # Check if it's a rate limit error (429)
-            if "429" in error_msg:
-                # Try to extract wait time from error or use exponential backoff
-                wait_time = (2**attempt) * 2
-                logger.warning(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}")
-                time.sleep(wait_time)
-                continue
-
-            # For server errors (5xx), retry with backoff
-            if any(f"{code}" in error_msg for code in range(500, 600)):
-                if attempt < max_retries - 1:
-                    wait_time = 2**attempt
-                    logger.warning(f"Server error, retrying in {wait_time}s (attempt {attempt + 1}/{max_retries})")
-                    time.sleep(wait_time)
-                    continue
-                logger.error(f"Server error persists after {max_retries} attempts: {e}")
-                return []
-
-            # For other errors, retry with exponential backoff
+        except ValueError:
+            data = response.text
+        # Validate response is a list of dicts (API sometimes returns unexpected formats)
+        if not isinstance(data, list):
+            logger.warning(f"API returned {type(data).__name__} instead of list: {str(data)[:200]}")
             if attempt < max_retries - 1:
-                wait_time = 2**attempt
-                logger.warning(f"Request error: {e}, retrying in {wait_time}s")
-                time.sleep(wait_time)
+                time.sleep(2**attempt)
                 continue
-
-            logger.error(f"Request failed after {max_retries} attempts: {e}")
-            raise
+            return []
+        return data
 
     # This should never be reached, but satisfies type checker
     return []
@@ -182,11 +194,28 @@ def salling_food_waste_source(zip_codes: list[str]):
         """Fetch clearance data from stores across multiple zip codes."""
         logger.debug(f"Starting food_waste_stores_resource with {len(zip_codes)} zip codes")
 
-        client = RESTClient(
-            base_url="https://api.sallinggroup.com/v1",
-            headers={"Authorization": f"Bearer {access_token}"},
-            paginator=SinglePagePaginator(),
-        )
+        # requests sessions aren't guaranteed thread-safe, so each worker thread gets its own client
+        thread_local = threading.local()
+        limiter = RateLimiter(REQUEST_INTERVAL_SECONDS)
+
+        def fetch_zip_code(zip_code: str) -> list[dict[str, Any]] | None:
+            client = getattr(thread_local, "client", None)
+            if client is None:
+                client = thread_local.client = RESTClient(
+                    base_url="https://api.sallinggroup.com/v1",
+                    headers={"Authorization": f"Bearer {access_token}"},
+                    paginator=SinglePagePaginator(),
+                )
+            limiter.wait()
+            try:
+                return fetch_with_retry(
+                    client=client,
+                    endpoint="food-waste/",
+                    params={"zip": zip_code},
+                )
+            except Exception as e:
+                logger.error(f"Failed to fetch data for zip code {zip_code}: {e}")
+                return None
 
         seen_store_ids = set()
         zip_codes_per_batch = 20  # Yield every 20 zip codes for better progress visibility
@@ -194,68 +223,108 @@ def salling_food_waste_source(zip_codes: list[str]):
 
         logger.debug("About to start fetching clearance data...")
         logger.info(f"Fetching clearance data for {len(zip_codes)} zip codes...")
-        logger.info(f"Estimated time: ~{len(zip_codes) * 2 / 60:.1f} minutes (2s delay per zip code)")
+        logger.info(
+            f"Estimated time: ~{len(zip_codes) * REQUEST_INTERVAL_SECONDS / 60:.1f} minutes "
+            f"({REQUEST_INTERVAL_SECONDS:g}s between requests)"
+        )
 
-        # Fetch all zip codes and yield in batches
-        for i, zip_code in enumerate(zip_codes, start=1):
-            logger.info(f"[{i}/{len(zip_codes)}] Processing zip code {zip_code}...")
+        # Fetch zip codes concurrently (results come back in order) and process them here,
+        # so deduplication and batching stay single-threaded
+        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+        try:
+            results = executor.map(fetch_zip_code, zip_codes)
+            for i, (zip_code, stores) in enumerate(zip(zip_codes, results, strict=True), start=1):
+                logger.info(f"[{i}/{len(zip_codes)}] Processing zip code {zip_code}...")
 
-            # Rate limiting: wait between requests (except for the first one)
-            if i > 1:
-                time.sleep(2)  # Conservative delay to avoid spike protection quarantine
+                if stores is None:
+                    continue
 
-            try:
-                stores = fetch_with_retry(
-                    client=client,
-                    endpoint="food-waste/",
-                    params={"zip": zip_code},
-                )
-            except Exception as e:
-                logger.error(f"Failed to fetch data for zip code {zip_code}: {e}")
-                continue
+                if not stores:
+                    logger.info(f"No stores found for zip code {zip_code}")
+                    continue
 
-            if not stores:
-                logger.info(f"No stores found for zip code {zip_code}")
-                continue
+                # Process stores from this zip code
+                stores_added = 0
+                for store_data in stores:
+                    store_id = store_data["store"]["id"]
 
-            # Process stores from this zip code
-            stores_added = 0
-            for store_data in stores:
-                store_id = store_data["store"]["id"]
+                    # Deduplicate
+                    if store_id in seen_store_ids:
+                        continue
 
-                # Deduplicate
-                if store_id in seen_store_ids:
-                    continue
+                    seen_store_ids.add(store_id)
+                    store_data["queried_zip_code"] = zip_code
 
-                seen_store_ids.add(store_id)
-                store_data["queried_zip_code"] = zip_code
+                    # Transform coordinates
+                    coords = store_data["store"].get("coordinates", [])
+                    if coords and len(coords) >= 2:
+                        store_data["store"]["longitude"] = coords[0]
+                        store_data["store"]["latitude"] = coords[1]
+                    store_data["store"].pop("coordinates", None)
 
-                # Transform coordinates
-                coords = store_data["store"].get("coordinates", [])
-                if coords and len(coords) >= 2:
-                    store_data["store"]["longitude"] = coords[0]
-                    store_data["store"]["latitude"] = coords[1]
-                store_data["store"].pop("coordinates", None)
+                    current_batch.append(store_data)
+                    stores_added += 1
 
-                current_batch.append(store_data)
-                stores_added += 1
+                logger.info(f"Zip {zip_code}: Added {stores_added} new stores (total unique: {len(seen_store_ids)})")
 
-            logger.info(f"Zip {zip_code}: Added {stores_added} new stores (total unique: {len(seen_store_ids)})")
+                # Yield batch every N zip codes to show progress
+                if (i % zip_codes_per_batch == 0 or i == len(zip_codes)) and current_batch:
+                    logger.info(f"Yielding batch of {len(current_batch)} stores...")
+                    yield current_batch
+                    current_batch = []
+        finally:
+            executor.shutdown(cancel_futures=True)
 
-            # Yield batch every N zip codes to show progress
-            if (i % zip_codes_per_batch == 0 or i == len(zip_codes)) and current_batch:
-                logger.info(f"Yielding batch of {len(current_batch)} stores...")
-                yield current_batch
-                current_batch = []
+        # Flush stores left over when the final zip codes returned nothing
+        if current_batch:
+            logger.info(f"Yielding batch of {len(current_batch)} stores...")
+            yield current_batch
 
         logger.info(f"Fetched clearance data from {len(seen_store_ids)} unique stores")
 
     return food_waste_stores_resource
 
 
+# Denormalized clearance rows for the web backend: one row per in-stock item with
+# its store id/brand and typed price columns, so the app never has to re-run the
+# stores ⋈ food_waste_stores ⋈ clearances join (or the casts) per request.
+STORE_CLEARANCES_SQL = """
+    CREATE OR REPLACE TABLE salling_data.store_clearances AS
+    SELECT
+        s.id AS store_id,
+        s.brand,
+        c.product__description,
+        c.product__categories__en,
+        c.product__image,
+        COALESCE(
+            CAST(c.offer__new_price AS DOUBLE),
+            {new_price_variant},
+            0
+        ) AS offer__new_price,
+        COALESCE(CAST(c.offer__original_price AS DOUBLE), 0) AS offer__original_price,
+        CAST(c.offer__percent_discount AS DOUBLE) AS offer__percent_discount,
+        CAST(c.offer__stock AS DOUBLE) AS offer__stock,
+        c.offer__stock_unit,
+        c.offer__end_time
+    FROM salling_data.all_stores s
+    INNER JOIN salling_data.food_waste_stores fw
+        ON s.id = fw.store__id
+    INNER JOIN salling_data.food_waste_stores__clearances c
+        ON fw._dlt_id = c._dlt_parent_id
+    WHERE CAST(c.offer__stock AS DOUBLE) > 0
+    ORDER BY store_id, c.offer__end_time
+"""
+
+
+DUCKDB_PATH = "sources/food_waste/salling_food_waste.duckdb"
+
+# Touched once a run has finished writing DUCKDB_PATH; the web backend watches it
+# to know when to reload, since the database file itself changes mid-run
+LOAD_COMPLETE_MARKER_PATH = f"{DUCKDB_PATH}.loaded"
+
 pipeline = dlt.pipeline(
     pipeline_name="salling_food_waste_pipeline",
-    destination=dlt.destinations.duckdb("sources/food_waste/salling_food_waste.duckdb"),
+    destination=dlt.destinations.duckdb(DUCKDB_PATH),
     dataset_name="salling_data",
     progress="log",
     dev_mode=False,
@@ -336,6 +405,33 @@ if __name__ == "__main__":
     logger.debug("Pipeline.run completed")
     logger.info(f"Load info: {load_info}")
 
+    # Step 4: Denormalize clearances into a single table for the web backend
+    logger.info("=" * 60)
+    logger.info("STEP 4: Building store_clearances table for the web backend")
+    logger.info("=" * 60)
+
+    with (
+        pipeline.sql_client() as client,
+        client.execute_query("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_schema = 'salling_data' AND table_name = 'food_waste_stores__clearances'
+        """) as cursor,
+    ):
+        clearance_columns = {row[0] for row in cursor.fetchall()}
+
+    if clearance_columns:
+        # dlt only adds the variant column when a run sees both int and float prices
+        has_price_variant = "offer__new_price__v_double" in clearance_columns
+        new_price_variant = "c.offer__new_price__v_double" if has_price_variant else "NULL"
+        with pipeline.sql_client() as client:
+            client.execute_sql(STORE_CLEARANCES_SQL.format(new_price_variant=new_price_variant))
+        logger.info("Built salling_data.store_clearances")
+    else:
+        logger.warning("No clearance data was loaded, skipping store_clearances")
+
+    Path(LOAD_COMPLETE_MARKER_PATH).touch()
+
     logger.info("=" * 60)
     logger.info("Pipeline completed successfully!")
     logger.info("=" * 60)
@@ -1,21 +1,31 @@
 """FastAPI backend for Spild Spotter chat application."""
 
+import asyncio
 import base64
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from functools import lru_cache
 from pathlib import Path
+from typing import NamedTuple
 
 import duckdb
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
-from google import genai
-from google.genai import types
-from google.oauth2 import service_account
 from pydantic import BaseModel
 
+# uvicorn only configures its own loggers, so log through its error logger to be shown
+logger = logging.getLogger("uvicorn.error")
+
 # Load environment variables from .env file in the parent directory
 load_dotenv(Path(__file__).parent.parent.parent / ".env")
 
@@ -23,7 +33,54 @@ load_dotenv(Path(__file__).parent.parent.parent / ".env")
 DB_PATH = str(Path(__file__).parent.parent.parent / "sources/food_waste/salling_food_waste.duckdb")
 SCHEMA_NAME = "salling_data"
 
-app = FastAPI(title="Spild Spotter API")
+# The pipeline touches this file after a run has fully finished writing the database
+LOAD_COMPLETE_MARKER_PATH = f"{DB_PATH}.loaded"
+
+# The backend only runs small point/aggregate queries, so a modest thread pool avoids
+# oversubscribing the host on tiny scans; both can be tuned per deployment
+DUCKDB_CONFIG = {
+    "threads": int(os.getenv("DUCKDB_THREADS", "4")),
+    "memory_limit": os.getenv("DUCKDB_MEMORY_LIMIT", "512MB"),
+}
+
+# How often to check whether a pipeline run has finished and the data should be reloaded
+DB_REFRESH_INTERVAL_SECONDS = float(os.getenv("DB_REFRESH_INTERVAL_SECONDS", "30"))
+
+# Only the soonest-expiring items go into the chat prompt; prompt length drives
+# both time-to-first-token and cost, and later items rarely change the recipes
+MAX_PROMPT_CLEARANCE_ITEMS = 50
+
+# Streamed chat text is flushed at the end of a sentence or line, once this many
+# characters are buffered, or once this long has passed since the previous flush
+STREAM_FLUSH_CHARS = 2048
+STREAM_FLUSH_SECONDS = 0.25
+STREAM_FLUSH_BOUNDARIES = (".", "!", "?", "\n")
+
+# Store/brand listings only change when the pipeline reloads the database, so
+# browsers may reuse them briefly and revalidate cheaply with the ETag afterwards
+RESPONSE_CACHE_CONTROL = "public, max-age=60"
+
+# Shown in place of missing or stub product image URLs
+PLACEHOLDER_IMAGE_URL = "https://placehold.co/80x80?text=No+Image"
+
+# Display names for store brands, keyed by the lowercase brand from the API
+BRAND_DISPLAY_NAMES = {
+    "foetex": "Føtex",
+    "bilka": "Bilka",
+    "netto": "Netto",
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm caches in the background so startup isn't blocked but first requests are fast."""
+    threading.Thread(target=warm_caches, daemon=True).start()
+    watcher = asyncio.create_task(watch_pipeline_runs())
+    yield
+    watcher.cancel()
+
+
+app = FastAPI(title="Spild Spotter API", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -34,14 +91,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON bodies such as the store list; the chat event stream is left uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=1000)  # ty: ignore[invalid-argument-type]  # Starlette ParamSpec limitation
+
 
 # =============================================================================
 # Credentials & Client Setup
 # =============================================================================
 
 
+@lru_cache(maxsize=1)
 def get_service_account_credentials():
     """Get GCP service account credentials from base64-encoded environment variable."""
+    # Google SDK imports are deferred to first use; they add ~0.4s to backend startup
+    from google.oauth2 import service_account
+
     encoded_key = os.getenv("GOOGLE_SERVICE_ACCOUNT_KEY_BASE64")
 
     if not encoded_key:
@@ -63,6 +127,8 @@ def get_service_account_credentials():
 @lru_cache(maxsize=1)
 def get_genai_client():
     """Get cached Gemini client configured for Vertex AI."""
+    from google import genai
+
     credentials = get_service_account_credentials()
     return genai.Client(
         vertexai=True,
@@ -72,197 +138,273 @@ def get_genai_client():
     )
 
 
+def get_genai_types():
+    """Get the Gemini SDK's request types module, imported on first use like the client."""
+    from google.genai import types
+
+    return types
+
+
 # =============================================================================
 # Database Query Functions
 # =============================================================================
 
 
-def get_db_connection():
-    """Get a read-only database connection."""
-    return duckdb.connect(DB_PATH, read_only=True)
+# SQL is built once at import so every call sends DuckDB the exact same text and
+# only the bound parameters change between executions.
+BRANDS_SQL = f"""
+    SELECT DISTINCT brand
+    FROM {SCHEMA_NAME}.store_clearances
+    ORDER BY brand
+"""
+
+ALL_STORES_SQL = f"""
+    SELECT DISTINCT
+        s.id,
+        s.name,
+        s.address__street,
+        s.address__city,
+        s.address__zip,
+        s.brand,
+        s.latitude,
+        s.longitude
+    FROM {SCHEMA_NAME}.all_stores s
+    WHERE s.id IN (SELECT store_id FROM {SCHEMA_NAME}.store_clearances)
+    ORDER BY s.brand, s.address__city, s.name
+"""
+
+STORE_DETAILS_SQL = f"""
+    SELECT
+        id,
+        name,
+        brand,
+        address__street,
+        address__city,
+        address__zip
+    FROM {SCHEMA_NAME}.all_stores
+"""
+
+ALL_CLEARANCES_SQL = f"""
+    SELECT
+        store_id,
+        product__description,
+        product__categories__en,
+        product__image,
+        offer__new_price,
+        offer__original_price,
+        offer__percent_discount,
+        offer__stock,
+        offer__stock_unit,
+        offer__end_time
+    FROM {SCHEMA_NAME}.store_clearances
+    ORDER BY store_id, offer__end_time ASC
+"""
+
+
+def get_db_connection() -> duckdb.DuckDBPyConnection:
+    """Open a read-only database connection; callers close it as soon as their load is done.
+
+    Every query is a one-off bulk load whose result is cached, so no handle is kept
+    between loads: even a read-only connection holds a file lock that would stop the
+    pipeline from writing while the backend is running.
+    """
+    return duckdb.connect(DB_PATH, read_only=True, config=DUCKDB_CONFIG)
+
+
+TABLE_EXISTS_SQL = "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = ?"
 
 
 def table_exists(conn, table_name: str) -> bool:
     """Check if a table exists in the database."""
-    result = conn.execute(
-        f"SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = '{SCHEMA_NAME}' AND table_name = ?",
-        [table_name],
-    ).fetchone()
+    result = conn.execute(TABLE_EXISTS_SQL, [SCHEMA_NAME, table_name]).fetchone()
     return result[0] > 0
 
 
-@lru_cache(maxsize=1)
-def get_brands() -> tuple[str, ...]:
-    """Get all unique store brands that have clearance items."""
+# Every cached loader below is keyed on a data generation: reload_data builds the next
+# generation in full while requests keep reading the current one, then swaps it in.
+# Loaders hold two entries so the current generation survives while the next is built.
+data_generation = 0
+
+
+@lru_cache(maxsize=2)
+def has_clearance_tables(generation: int) -> bool:
+    """Check once whether the pipeline has built the store_clearances table."""
     conn = get_db_connection()
     try:
-        if not table_exists(conn, "food_waste_stores") or not table_exists(conn, "food_waste_stores__clearances"):
-            # No clearance data available, return empty
-            return ()
+        return table_exists(conn, "store_clearances")
+    finally:
+        conn.close()
+
 
+@lru_cache(maxsize=2)
+def get_brands(generation: int) -> tuple[str, ...]:
+    """Get all unique store brands that have clearance items."""
+    if not has_clearance_tables(generation):
+        # No clearance data available, return empty
+        return ()
+
+    conn = get_db_connection()
+    try:
         # Only return brands that have stores with actual clearance items
-        brands = conn.execute(f"""
-            SELECT DISTINCT s.brand
-            FROM {SCHEMA_NAME}.all_stores s
-            INNER JOIN {SCHEMA_NAME}.food_waste_stores fw
-                ON s.id = fw.store__id
-            INNER JOIN {SCHEMA_NAME}.food_waste_stores__clearances c
-                ON fw._dlt_id = c._dlt_parent_id
-            WHERE CAST(c.offer__stock AS DOUBLE) > 0
-            ORDER BY s.brand
-        """).fetchall()
+        brands = conn.execute(BRANDS_SQL).fetchall()
         return tuple(b[0] for b in brands)
     finally:
         conn.close()
 
 
-@lru_cache(maxsize=1)
-def get_all_stores() -> tuple[tuple[str, str, str, str, float | None, float | None, str], ...]:
+@lru_cache(maxsize=2)
+def get_all_stores(generation: int) -> tuple[tuple[str, str, str, str, float | None, float | None, str], ...]:
     """Get all stores that have clearance items with stock > 0."""
+    if not has_clearance_tables(generation):
+        # No clearance data available, return empty
+        return ()
+
     conn = get_db_connection()
     try:
-        if not table_exists(conn, "food_waste_stores") or not table_exists(conn, "food_waste_stores__clearances"):
-            # No clearance data available, return empty
-            return ()
-
         # Only return stores that have actual clearance items with stock
-        stores = conn.execute(f"""
-            SELECT DISTINCT
-                s.id,
-                s.name,
-                s.address__street,
-                s.address__city,
-                s.address__zip,
-                s.brand,
-                s.latitude,
-                s.longitude
-            FROM {SCHEMA_NAME}.all_stores s
-            INNER JOIN {SCHEMA_NAME}.food_waste_stores fw
-                ON s.id = fw.store__id
-            INNER JOIN {SCHEMA_NAME}.food_waste_stores__clearances c
-                ON fw._dlt_id = c._dlt_parent_id
-            WHERE CAST(c.offer__stock AS DOUBLE) > 0
-            ORDER BY s.brand, s.address__city, s.name
-        """).fetchall()
+        stores = conn.execute(ALL_STORES_SQL).fetchall()
 
         results = []
-        for store in stores:
-            store_id, name, street, city, zip_code, brand, lat, lng = store
-            # Format brand name nicely
-            display_brand = {
-                "foetex": "Føtex",
-                "bilka": "Bilka",
-                "netto": "Netto",
-            }.get(brand.lower(), brand.title())
+        for store_id, name, street, city, zip_code, brand, lat, lng in stores:
+            brand_key = brand.lower()
+            display_brand = BRAND_DISPLAY_NAMES.get(brand_key) or brand.title()
             label = f"{display_brand} - {name}, {street}, {zip_code} {city}"
-            results.append((store_id, label, city, display_brand, lat, lng, brand.lower()))
+            results.append((store_id, label, city, display_brand, lat, lng, brand_key))
 
         return tuple(results)
     finally:
         conn.close()
 
 
-@lru_cache(maxsize=128)
-def get_store_details(store_id: str) -> dict | None:
-    """Fetch store details from all_stores table."""
+class ClearanceRow(NamedTuple):
+    """A clearance item as stored in store_clearances (nullable columns may be None)."""
+
+    product__description: str | None
+    product__categories__en: str | None
+    product__image: str | None
+    offer__new_price: float | None
+    offer__original_price: float | None
+    offer__percent_discount: float | None
+    offer__stock: float | None
+    offer__stock_unit: str | None
+    offer__end_time: str | None
+
+
+@lru_cache(maxsize=2)
+def load_store_details(generation: int) -> dict[str, dict]:
+    """Load details for every store once, keyed by store ID."""
     conn = get_db_connection()
     try:
-        result = conn.execute(
-            f"""
-            SELECT
-                id,
-                name,
-                brand,
-                address__street,
-                address__city,
-                address__zip
-            FROM {SCHEMA_NAME}.all_stores
-            WHERE id = ?
-            LIMIT 1
-        """,
-            [store_id],
-        ).fetchone()
-        if result is None:
-            return None
         columns = ["id", "name", "brand", "street", "city", "zip"]
-        return dict(zip(columns, result, strict=True))
+        details: dict[str, dict] = {}
+        for row in conn.execute(STORE_DETAILS_SQL).fetchall():
+            details.setdefault(row[0], dict(zip(columns, row, strict=True)))
+        return details
     finally:
         conn.close()
 
 
-@lru_cache(maxsize=128)
-def get_store_clearances(store_id: str) -> tuple[dict, ...]:
-    """Fetch clearance items for a specific store."""
+@lru_cache(maxsize=2)
+def load_store_clearances(generation: int) -> dict[str, tuple[ClearanceRow, ...]]:
+    """Load every in-stock clearance item once, grouped by store ID and ordered by end time.
+
+    Rows are kept as named tuples rather than dicts: thousands of items share one
+    set of field names instead of each carrying its own key table.
+    """
+    if not has_clearance_tables(generation):
+        return {}
+
     conn = get_db_connection()
     try:
-        if not table_exists(conn, "food_waste_stores") or not table_exists(conn, "food_waste_stores__clearances"):
-            return ()
-
-        clearances = conn.execute(
-            f"""
-            SELECT
-                c.product__description,
-                c.product__categories__en,
-                c.product__image,
-                COALESCE(
-                    CAST(c.offer__new_price AS DOUBLE),
-                    c.offer__new_price__v_double,
-                    0
-                ) AS offer__new_price,
-                COALESCE(
-                    CAST(c.offer__original_price AS DOUBLE),
-                    0
-                ) AS offer__original_price,
-                CAST(c.offer__percent_discount AS DOUBLE) AS offer__percent_discount,
-                CAST(c.offer__stock AS DOUBLE) AS offer__stock,
-                c.offer__stock_unit,
-                c.offer__end_time
-            FROM {SCHEMA_NAME}.all_stores s
-            INNER JOIN {SCHEMA_NAME}.food_waste_stores fw
-                ON s.id = fw.store__id
-            INNER JOIN {SCHEMA_NAME}.food_waste_stores__clearances c
-                ON fw._dlt_id = c._dlt_parent_id
-            WHERE s.id = ?
-            AND CAST(c.offer__stock AS DOUBLE) > 0
-            ORDER BY c.offer__end_time ASC
-        """,
-            [store_id],
-        ).fetchall()
-
-        columns = [
-            "product__description",
-            "product__categories__en",
-            "product__image",
-            "offer__new_price",
-            "offer__original_price",
-            "offer__percent_discount",
-            "offer__stock",
-            "offer__stock_unit",
-            "offer__end_time",
-        ]
-        return tuple(dict(zip(columns, row, strict=True)) for row in clearances)
+        grouped: defaultdict[str, list[ClearanceRow]] = defaultdict(list)
+        for store_id, *row in conn.execute(ALL_CLEARANCES_SQL).fetchall():
+            grouped[store_id].append(ClearanceRow(*row))
+        return {store_id: tuple(items) for store_id, items in grouped.items()}
     finally:
         conn.close()
 
 
-def sanitize_text(text: str | None) -> str:
-    """Sanitize text to ensure it's valid UTF-8."""
-    if text is None:
-        return ""
-    return text.encode("utf-8", errors="replace").decode("utf-8")
+def get_store_details(generation: int, store_id: str) -> dict | None:
+    """Get store details from the preloaded all_stores data."""
+    return load_store_details(generation).get(store_id)
+
+
+def get_store_clearances(generation: int, store_id: str) -> tuple[ClearanceRow, ...]:
+    """Get the preloaded clearance items for a specific store."""
+    return load_store_clearances(generation).get(store_id, ())
+
+
+def load_generation(generation: int) -> None:
+    """Load the store data and listing responses for a generation from the database."""
+    get_brands_json(generation)
+    for brand_key in get_store_choices(generation):
+        get_stores_json(generation, brand_key)
+    load_store_details(generation)
+    load_store_clearances(generation)
+
+
+def warm_caches() -> None:
+    """Preload store data and set up the Gemini client ahead of the first requests."""
+    try:
+        load_generation(data_generation)
+    except Exception as e:
+        logger.warning(f"Could not preload store data: {e}")
+
+    try:
+        get_genai_client()
+    except Exception as e:
+        logger.warning(f"Could not initialize Gemini client: {e}")
+
+
+def get_load_marker_mtime() -> float | None:
+    """Get when the pipeline last finished a run, or None if it never has."""
+    try:
+        return os.stat(LOAD_COMPLETE_MARKER_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def reload_data() -> None:
+    """Load the rewritten database as a new generation, then switch requests over to it.
+
+    Requests keep being served from the current generation until the new one is fully
+    built, and results computed from the old data can't leak into the new caches.
+    """
+    global data_generation
+    next_generation = data_generation + 1
+    load_generation(next_generation)
+    data_generation = next_generation
+
+
+async def watch_pipeline_runs() -> None:
+    """Reload cached data whenever a pipeline run completes, without an app restart.
+
+    The database file changes throughout a run, so this waits for the completion
+    marker rather than reacting to the file itself and caching a half-built database.
+    """
+    last_mtime = get_load_marker_mtime()
+    while True:
+        await asyncio.sleep(DB_REFRESH_INTERVAL_SECONDS)
+        mtime = get_load_marker_mtime()
+        if mtime is None or mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        logger.info("Pipeline run completed, reloading store data")
+        try:
+            await asyncio.to_thread(reload_data)
+        except Exception as e:
+            logger.warning(f"Could not reload store data: {e}")
 
 
 def to_title_case(text: str | None) -> str:
     """Convert text to title case (proper case)."""
-    if text is None:
+    if not text:
         return ""
-    # First sanitize, then convert to title case
-    sanitized = sanitize_text(text)
     # Handle all-caps text by converting to title case
     # This preserves already properly cased text
-    if sanitized.isupper():
-        return sanitized.title()
-    return sanitized
+    if text.isupper():
+        return text.title()
+    return text
 
 
 def format_price(price: float) -> str:
@@ -273,34 +415,40 @@ def format_price(price: float) -> str:
         return f"{price:.2f} kr"
 
 
-def format_clearance_items(clearances: tuple[dict, ...]) -> str:
+CLEARANCE_LINE_TEMPLATE = (
+    "- {description} ({category}): {new_price} (was {original_price}, {discount:.0f}% off), "
+    "~{stock:.2f} {stock_unit} available"
+)
+
+
+def format_clearance_line(item: ClearanceRow) -> str:
+    """Format a single clearance item as a bullet line for the LLM."""
+    return CLEARANCE_LINE_TEMPLATE.format(
+        description=to_title_case(item.product__description) or "Unknown item",
+        category=item.product__categories__en or "Uncategorized",
+        new_price=format_price(item.offer__new_price or 0),
+        original_price=format_price(item.offer__original_price or 0),
+        discount=item.offer__percent_discount or 0,
+        stock=item.offer__stock or 0,
+        stock_unit=item.offer__stock_unit or "units",
+    )
+
+
+def format_clearance_items(clearances: tuple[ClearanceRow, ...]) -> str:
     """Format clearance items into a readable string for the LLM."""
     if not clearances:
         return "No clearance items currently available at this store."
 
-    lines = []
-    for item in clearances:
-        description = to_title_case(item.get("product__description")) or "Unknown item"
-        category = sanitize_text(item.get("product__categories__en")) or "Uncategorized"
-        new_price = item.get("offer__new_price", 0) or 0
-        original_price = item.get("offer__original_price", 0) or 0
-        discount = item.get("offer__percent_discount") or 0
-        stock = item.get("offer__stock", 0) or 0
-        stock_unit = sanitize_text(item.get("offer__stock_unit")) or "units"
-
-        lines.append(
-            f"- {description} ({category}): {format_price(new_price)} "
-            f"(was {format_price(original_price)}, {discount:.0f}% off), "
-            f"~{stock:.2f} {stock_unit} available"
-        )
-
+    lines = [format_clearance_line(item) for item in clearances[:MAX_PROMPT_CLEARANCE_ITEMS]]
+    if len(clearances) > MAX_PROMPT_CLEARANCE_ITEMS:
+        lines.append(f"- ...and {len(clearances) - MAX_PROMPT_CLEARANCE_ITEMS} more items expiring later")
     return "\n".join(lines)
 
 
-def build_system_prompt(store_name: str, store_brand: str, clearances: tuple[dict, ...]) -> str:
+def build_system_prompt(store_name: str, store_brand: str, clearances: tuple[ClearanceRow, ...]) -> str:
     """Build the system prompt with store context and clearance items."""
-    store_name = sanitize_text(store_name)
-    store_brand = sanitize_text(store_brand)
+    store_name = store_name or ""
+    store_brand = store_brand or ""
     items_text = format_clearance_items(clearances)
 
     return f"""CRITICAL LANGUAGE INSTRUCTION:
@@ -339,6 +487,17 @@ WHEN PROVIDING RECIPES (only when asked):
 REMEMBER: Your entire response must be in English."""
 
 
+@lru_cache(maxsize=128)
+def get_store_system_prompt(generation: int, store_id: str) -> str:
+    """Build the system prompt for a store once and reuse it across chat turns."""
+    store_details = get_store_details(generation, store_id) or {}
+    return build_system_prompt(
+        store_details.get("name", "Unknown Store"),
+        store_details.get("brand", ""),
+        get_store_clearances(generation, store_id),
+    )
+
+
 # =============================================================================
 # Pydantic Models
 # =============================================================================
@@ -383,6 +542,68 @@ class ChatRequest(BaseModel):
     history: list[ChatMessage] = []
 
 
+# =============================================================================
+# Response Caching
+# =============================================================================
+
+
+class CachedJSON(NamedTuple):
+    """A response body serialized once, with an ETag derived from its content."""
+
+    body: bytes
+    etag: str
+
+
+def to_cached_json(content) -> CachedJSON:
+    """Serialize content the way FastAPI's JSONResponse would and tag it."""
+    body = json.dumps(
+        jsonable_encoder(content),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    # Weak, since GZipMiddleware may send the same entity gzip-encoded or as is
+    return CachedJSON(body=body, etag=f'W/"{hashlib.sha1(body).hexdigest()}"')
+
+
+def cached_json_response(request: Request, cached: CachedJSON) -> Response:
+    """Return the pre-serialized body, or 304 if the client already holds this version."""
+    headers = {"ETag": cached.etag, "Cache-Control": RESPONSE_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # If-None-Match uses weak comparison, so the W/ prefix is ignored on both sides
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if cached.etag.removeprefix("W/") in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+
+@lru_cache(maxsize=2)
+def get_brands_json(generation: int) -> CachedJSON:
+    """Serialized /api/brands body."""
+    return to_cached_json(list(get_brands(generation)))
+
+
+@lru_cache(maxsize=32)
+def get_stores_json(generation: int, brand_key: str | None) -> CachedJSON:
+    """Serialized /api/stores body for one lowercase brand (None for every store)."""
+    return to_cached_json(list(get_store_choices(generation).get(brand_key, ())))
+
+
+@lru_cache(maxsize=256)
+def get_store_details_json(generation: int, store_id: str) -> CachedJSON | None:
+    """Serialized /api/stores/{store_id} body, or None if the store is unknown."""
+    details = get_store_details(generation, store_id)
+    return to_cached_json(StoreDetails(**details)) if details else None
+
+
+@lru_cache(maxsize=256)
+def get_clearances_json(generation: int, store_id: str) -> CachedJSON:
+    """Serialized /api/stores/{store_id}/clearances body."""
+    return to_cached_json(list(get_clearance_items(generation, store_id)))
+
+
 # =============================================================================
 # API Routes
 # =============================================================================
@@ -395,71 +616,78 @@ async def health_check():
 
 
 @app.get("/api/brands", response_model=list[str])
-async def list_brands():
+async def list_brands(request: Request):
     """Get all available brands."""
     try:
-        return list(get_brands())
+        return cached_json_response(request, get_brands_json(data_generation))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+@lru_cache(maxsize=2)
+def get_store_choices(generation: int) -> dict[str | None, tuple[Store, ...]]:
+    """Build the store selector entries once, grouped by lowercase brand (None holds every store)."""
+    choices: defaultdict[str | None, list[Store]] = defaultdict(list)
+    for s in get_all_stores(generation):
+        store = Store.model_construct(id=s[0], label=s[1], city=s[2], brand=s[3], latitude=s[4], longitude=s[5])
+        choices[None].append(store)
+        choices[s[6]].append(store)
+    return {brand_key: tuple(stores) for brand_key, stores in choices.items()}
+
+
 @app.get("/api/stores", response_model=list[Store])
-async def list_stores(brand: str | None = None):
+async def list_stores(request: Request, brand: str | None = None):
     """Get all stores, optionally filtered by brand."""
     try:
-        stores = get_all_stores()
-        result = [
-            Store(id=s[0], label=s[1], city=s[2], brand=s[3], latitude=s[4], longitude=s[5])
-            for s in stores
-            if not brand or s[6] == brand.lower()
-        ]
-        return result
+        return cached_json_response(request, get_stores_json(data_generation, brand.lower() if brand else None))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
 @app.get("/api/stores/{store_id}", response_model=StoreDetails | None)
-async def get_store(store_id: str):
+async def get_store(request: Request, store_id: str):
     """Get store details by ID."""
     try:
-        details = get_store_details(store_id)
-        if not details:
+        cached = get_store_details_json(data_generation, store_id)
+        if cached is None:
             raise HTTPException(status_code=404, detail="Store not found")
-        return StoreDetails(**details)
+        return cached_json_response(request, cached)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+def display_image_url(url: str | None) -> str:
+    """Return the product image URL, or the placeholder if the API gave none or a stub."""
+    if not url or len(url) < 20 or url.endswith("/image"):
+        return PLACEHOLDER_IMAGE_URL
+    return url
+
+
+@lru_cache(maxsize=256)
+def get_clearance_items(generation: int, store_id: str) -> tuple[ClearanceItem, ...]:
+    """Format a store's clearance items for display once and reuse them across requests."""
+    # Values come from our own table and are formatted as strings right here, so skip validation
+    return tuple(
+        ClearanceItem.model_construct(
+            image=display_image_url(item.product__image),
+            product=to_title_case(item.product__description) or "Unknown",
+            category=item.product__categories__en or "",
+            new_price=f"{item.offer__new_price or 0:.2f} DKK",
+            original_price=f"{item.offer__original_price or 0:.2f} DKK",
+            discount=f"{item.offer__percent_discount or 0:.0f}%",
+            stock=f"{item.offer__stock or 0:.1f} {item.offer__stock_unit or ''}",
+        )
+        for item in get_store_clearances(generation, store_id)
+    )
+
+
 @app.get("/api/stores/{store_id}/clearances", response_model=list[ClearanceItem])
-async def get_clearances(store_id: str):
+async def get_clearances(request: Request, store_id: str):
     """Get clearance items for a store."""
     try:
-        clearances = get_store_clearances(store_id)
-        items = []
-        for item in clearances:
-            image_url = item.get("product__image", "")
-            if not image_url or len(image_url) < 20 or image_url.endswith("/image"):
-                image_url = "https://placehold.co/80x80?text=No+Image"
-
-            new_price = item.get("offer__new_price") or 0
-            original_price = item.get("offer__original_price") or 0
-            discount = item.get("offer__percent_discount") or 0
-            stock = item.get("offer__stock") or 0
-
-            items.append(
-                ClearanceItem(
-                    image=image_url,
-                    product=to_title_case(item.get("product__description")) or "Unknown",
-                    category=sanitize_text(item.get("product__categories__en")) or "",
-                    new_price=f"{new_price:.2f} DKK",
-                    original_price=f"{original_price:.2f} DKK",
-                    discount=f"{discount:.0f}%",
-                    stock=f"{stock:.1f} {sanitize_text(item.get('offer__stock_unit')) or ''}",
-                )
-            )
-        return items
+        return cached_json_response(request, get_clearances_json(data_generation, store_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
@@ -468,11 +696,13 @@ async def get_clearances(store_id: str):
 async def chat(request: ChatRequest):
     """Stream a chat response."""
     try:
-        store_details = get_store_details(request.store_id)
+        # Read the generation once so the whole request sees a single pipeline run's data
+        generation = data_generation
+        store_details = get_store_details(generation, request.store_id)
         if not store_details:
             raise HTTPException(status_code=404, detail="Store not found")
 
-        clearances = get_store_clearances(request.store_id)
+        clearances = get_store_clearances(generation, request.store_id)
         if not clearances:
 
             async def no_items_response():
@@ -483,31 +713,25 @@ async def chat(request: ChatRequest):
 
             return StreamingResponse(no_items_response(), media_type="text/plain")
 
-        system_prompt = build_system_prompt(
-            store_details.get("name", "Unknown Store"),
-            store_details.get("brand", ""),
-            clearances,
-        )
+        system_prompt = get_store_system_prompt(generation, request.store_id)
 
+        types = get_genai_types()
         client = get_genai_client()
 
-        # Build message history
-        contents = []
-        for msg in request.history:
-            contents.append(
+        # Build message history plus the current message in a single list
+        contents = [
+            *(
                 types.Content(
                     role="user" if msg.role == "user" else "model",
                     parts=[types.Part.from_text(text=msg.content)],
                 )
-            )
-
-        # Add current message
-        contents.append(
+                for msg in request.history
+            ),
             types.Content(
                 role="user",
                 parts=[types.Part.from_text(text=request.message)],
-            )
-        )
+            ),
+        ]
 
         # Generate streaming response
         generate_content_config = types.GenerateContentConfig(
@@ -516,14 +740,34 @@ async def chat(request: ChatRequest):
         )
 
         async def generate():
-            response = client.models.generate_content_stream(
+            # Use the async client so waiting on Gemini doesn't block the event loop for other requests
+            response = await client.aio.models.generate_content_stream(
                 model="gemini-2.5-flash",
                 contents=contents,
                 config=generate_content_config,
             )
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text
+            # Coalesce deltas into whole sentences so each network write carries a useful
+            # amount of text, with size and time caps so long runs still appear promptly
+            buffer: list[str] = []
+            buffered_chars = 0
+            last_flush = time.monotonic()
+            async for chunk in response:
+                if not chunk.text:
+                    continue
+                buffer.append(chunk.text)
+                buffered_chars += len(chunk.text)
+                now = time.monotonic()
+                if (
+                    chunk.text.endswith(STREAM_FLUSH_BOUNDARIES)
+                    or buffered_chars >= STREAM_FLUSH_CHARS
+                    or now - last_flush >= STREAM_FLUSH_SECONDS
+                ):
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered_chars = 0
+                    last_flush = now
+            if buffer:
+                yield "".join(buffer)
 
         return StreamingResponse(
             generate(),